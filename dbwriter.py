@@ -1,6 +1,24 @@
 import argparse
 import csv
 import logging
+import os
+import sys
+from collections import Counter
+
+# Bytes of encoded records buffered before each write to the output file
+WRITE_BUFFER_SIZE = 64 << 20
+
+# Columns that are not written as record fields
+SKIP_HEADERS = frozenset(("RECNAME", "RECTYPE", "IGNORE"))
+
+# Common spellings of an IGNORE cell set to true
+TRUE_VALUES = frozenset(("true", "True", "TRUE"))
+
+# Closes a field line opened by its per-column prefix
+FIELD_SUFFIX = '" )\n'
+
+# Closes a record
+RECORD_END = "}\n\n"
 
 # TODO: Check that fields are valid for record types, count and indicate row #'s
 # TODO: Check CSV encoding - read appropriately
@@ -20,27 +38,64 @@ def duplicates_found(recname_list):
     duplicates : set
         Set of RECNAME values that have duplicates
     """   
-    duplicates = []
-    seen = set()
-    for name in recname_list:
-        if name in seen:
-            duplicates.append(name)
-        seen.add(name)
-    return set(duplicates)
+    return {name for name, count in Counter(recname_list).items() if count > 1}
 
 
-def input_error(input_path):
+def row_ranges(row_nums):
     """
-    Checks the input filepath for the stats on ignored line and the following errors:
+    Collapses row numbers into contiguous spans for the error report.
+
+    params
+    ----------------
+    row_nums : list
+        Row numbers, in any order
+
+    yields
+    ----------------
+    span : str
+        "first-last" for each run of consecutive rows, or "row" for a single row
+    """
+    it = iter(sorted(row_nums))
+    first = last = next(it, None)
+    if first is None:
+        return
+    for num in it:
+        if num != last + 1:
+            yield f"{first}-{last}" if first != last else str(first)
+            first = num
+        last = num
+    yield f"{first}-{last}" if first != last else str(first)
+
+
+def process(input_path, output_db, fail_fast=False):
+    """
+    Use CSV indicated by input_path to output an EPICS database file as output_db.
+
+    The CSV is read once. Records are written to a temporary file alongside
+    output_db while the input is checked for the stats on ignored lines and
+    the following errors:
     1. File does not end with .csv - break
     2. Does not contains headers: RECNAME and RECTYPE - break
     3. Rows missing RECNAME or RECTYPE
     4. Duplicate RECNAME instances
-    
+    If no errors are found the temporary file replaces output_db, otherwise
+    it is removed.
+
+    Input file must have RECTYPE and RECNAME columns. It may have an IGNORE column
+    which, if set to "true", will ignore that row/ record. Other column heads will
+    be treated as fields of a record and its value set to the corresponding cell.
+
     params
     ----------------
     input_path : str
         String of full filepath to input CSV file
+
+    output_db : str
+        String of full filepath to output '.db' file
+
+    fail_fast : boolean
+        Stop reading at the first row missing RECNAME/RECTYPE or with a
+        duplicate RECNAME
         
     returns
     ----------------
@@ -57,20 +112,21 @@ def input_error(input_path):
         "name": {"msg": "Duplicate Record Names", "rows": []},
         "ignored": {"msg": "Rows ignored", "rows": []},
     }
+    # err_log keys that are reported but do not prevent writing output_db
+    info_only = {"ignored"}
 
-    logging.debug(f"...opening {input_path}")
-    with open(input_path, "r", encoding="utf-8-sig") as csvfile:
-
-        # If input file is not CSV, return error
-        logging.debug("...file extension: .csv")
-        if not input_path.endswith(".csv"):
-            logging.info(f"Error: {input_path} is not a CSV file")
-            return True
+    # If input file is not CSV, return error before reading it
+    logging.debug("...file extension: .csv")
+    if not input_path.endswith(".csv"):
+        logging.info(f"Error: {input_path} is not a CSV file")
+        return True
 
-        reader = csv.DictReader(csvfile)
+    logging.debug(f"...opening {input_path}")
+    with open(input_path, "r", encoding="utf-8-sig", buffering=1 << 20) as csvfile:
+        reader = csv.reader(csvfile)
 
         # If CSV is missing necessary headers, return error
-        headers = reader.fieldnames
+        headers = next(reader, None)
         logging.debug("...RECNAME and RECTYPE in headers")
         if (
             headers is None
@@ -81,130 +137,131 @@ def input_error(input_path):
             logging.info("Error: The CSV file must have at least 'RECNAME' and 'RECTYPE'")
             return True
 
-
-        # Check each row for records with errors
-        # If row is missing RECTYPE or RECNAME and not IGNORE, append row to error report
-        logging.debug("...rows where IGNORE = true and rows missing RECTYPE or RECNAME")
-        recnames = []
-        row_num = 1
-        for row in reader:
-            recname = row["RECNAME"]
-            rectype = row["RECTYPE"]
-
-            if "IGNORE" in headers and (row["IGNORE"].lower() == "true"):
-                logging.debug(f"......row: {row_num}")
-                logging.debug(".........ignored")
-                err_log["ignored"]["rows"].append(row_num)
-            elif not recname:
-                logging.debug(f"......row: {row_num}")
-                logging.debug(".........missing RECNAME")
-                err_log["missing_name"]["rows"].append(row_num)
-            elif not rectype:
-                logging.debug(f"......row: {row_num}")
-                logging.debug(".........missing RECTYPE")
-                err_log["missing_type"]["rows"].append(row_num)
-            else:
-                recnames.append(recname)
-            row_num += 1
-
-        # Check record names for duplicates
-        logging.debug("...duplicate RECNAME instances")
-        err_log["name"]["rows"] = duplicates_found(recnames)
-
-        # Iterate over err_log dictionary, print any with len(row)>0 && error true
-        err_return = False
-        err_list = []
-        for err in err_log:
-            logging.debug(f"{err}: {len(err_log[err]["rows"])}")
-            if len(err_log[err]["rows"]) > 0:
-                err_list.append(err_log[err]["msg"] + ", rows: " + str(err_log[err]["rows"]))
-                err_return = True
-
-        err_message = "\n".join(e for e in err_list)
-        if err_return:
-            logging.info(err_message)
-        else:
-            logging.info("No errors found")
-            return err_return
-
-
-def process_csv(input_path, output_db):
-    """
-    Use CSV indicated by input_path to output an EPICS database file as output_db.
-
-    Input file must have RECTYPE and RECNAME columns. It may have an IGNORE column
-    which, if set to "true", will ignore that row/ record. Other column heads will
-    be treated as fields of a record and its value set to the corresponding cell.
-
-    params
-    ----------------
-    input_path : str
-        String of full filepath to input CSV file
-
-    output_db : str
-        String of full filepath to output '.db' file
-        
-    returns
-    ----------------
-    """
-
-    try:
-        # Read the CSV file
-        logging.debug(f"Opening file: {input_path}")
-        with open(input_path, "r", encoding="utf-8-sig") as csvfile:
-            reader = csv.DictReader(csvfile)
-            headers = reader.fieldnames
-            fields = [h for h in headers if h not in ['RECNAME', 'RECTYPE', 'IGNORE']]
-            row_num = 0
-
-            # Open the output file
-            with open(output_db, "w") as outfile:
-                # Process each row in the CSV
-
-                ignore_h = "IGNORE" in headers
-                count_recs = 0 # count records written
-                count_ignore = 0 # count rows ignored
-                count_skip = 0 # count rows skipped
-
+        name_i = headers.index("RECNAME")
+        type_i = headers.index("RECTYPE")
+        ignore_i = headers.index("IGNORE") if "IGNORE" in headers else -1
+        ncols = len(headers)
+        # Field line prefix is constant per column, so build it once
+        field_idx = [
+            (f'    field ( {h}, "', i)
+            for i, h in enumerate(headers)
+            if h not in SKIP_HEADERS
+        ]
+
+        tmp_db = output_db + ".tmp"
+        try:
+            # Records are encoded into a bytearray, so write bytes and skip TextIOWrapper
+            with open(tmp_db, "wb") as outfile:
+
+                # Check each row for records with errors and write the rest
+                # If row is missing RECTYPE or RECNAME and not IGNORE, append row to error report
+                logging.debug("...rows where IGNORE = true and rows missing RECTYPE or RECNAME")
+                recnames = []
+                buf = bytearray()
+                log_debug = logging.debug
+                write = outfile.write
+                add_recname = recnames.append
+                add_record = buf.extend
+                append_ignored = err_log["ignored"]["rows"].append
+                append_missing_name = err_log["missing_name"]["rows"].append
+                append_missing_type = err_log["missing_type"]["rows"].append
+                seen = set()
+                add_seen = seen.add
+                row_num = 1
                 for row in reader:
-                    row_num += 1
-                    recname = row["RECNAME"]
-                    rectype = row["RECTYPE"]
-
-                    ignore = False
-                    skip = False
-
-                    if ignore_h: 
-                        ignore = row["IGNORE"].lower() == "true"
-                        if ignore:
-                            logging.debug(f"...row:{row_num} ignored")
-                            count_ignore += 1
-                            ignore = True
-                    
-                    if not (recname and rectype):
-                        logging.debug(f"...row:{row_num} skipped - missing name or type")
-                        skip = True
-                        count_skip += 1
-
-                    if not (ignore or skip): 
-                        count_recs +=1
-
-                        # Write the record to the output file
-                        outfile.write(f'record ( {rectype}, "{recname}") {{\n')
-
-                        # Write the fields, skipping the empty values
-                        for field in fields:
-                            value = row.get[field]
+                    # Skip blank lines, as DictReader did
+                    if not row:
+                        continue
+                    # Pad short rows with empty cells, as DictReader did
+                    if len(row) < ncols:
+                        row += [""] * (ncols - len(row))
+                    recname = row[name_i]
+                    rectype = row[type_i]
+
+                    row_err = False
+
+                    # Only lower-case uncommon 4 character spellings of "true"
+                    ignore = row[ignore_i] if ignore_i >= 0 else ""
+                    if ignore in TRUE_VALUES or (
+                        len(ignore) == 4 and ignore.lower() == "true"
+                    ):
+                        log_debug("......row: %d", row_num)
+                        log_debug(".........ignored")
+                        append_ignored(row_num)
+                    elif not recname:
+                        log_debug("......row: %d", row_num)
+                        log_debug(".........missing RECNAME")
+                        append_missing_name(row_num)
+                        row_err = True
+                    elif not rectype:
+                        log_debug("......row: %d", row_num)
+                        log_debug(".........missing RECTYPE")
+                        append_missing_type(row_num)
+                        row_err = True
+                    else:
+                        add_recname(recname)
+                        if fail_fast:
+                            row_err = recname in seen
+                            add_seen(recname)
+
+                        # Build the record, skipping the empty field values
+                        parts = [f'record ( {rectype}, "{recname}") {{\n']
+                        for prefix, i in field_idx:
+                            value = row[i]
                             if value:
-                                outfile.write(f'    field ( {field}, "{value}" )\n')
+                                parts.append(prefix)
+                                parts.append(value)
+                                parts.append(FIELD_SUFFIX)
+                        parts.append(RECORD_END)
+                        add_record("".join(parts).encode())
+
+                        # Write the buffered records to the output file
+                        if len(buf) >= WRITE_BUFFER_SIZE:
+                            write(buf)
+                            buf.clear()
+
+                    if fail_fast and row_err:
+                        logging.info("...stopping at row %d (fail fast)", row_num)
+                        break
+                    row_num += 1
 
-                        outfile.write("}\n\n")
-        logging.info(f"{count_recs} records written")
-        logging.info(f"{count_ignore} records ignored")
-        logging.info(f"{count_skip} records skipped")
+                write(buf)
+
+            # Check record names for duplicates
+            logging.debug("...duplicate RECNAME instances")
+            err_log["name"]["rows"] = duplicates_found(recnames)
+
+            # Iterate over err_log dictionary, print any with len(row)>0 && error true
+            err_return = False
+            err_list = []
+            for err in err_log:
+                rows = err_log[err]["rows"]
+                logging.debug("%s: %d", err, len(rows))
+                if len(rows) > 0:
+                    # Duplicates are reported by name, other errors by row number
+                    if err == "name":
+                        rows_str = ",".join(sorted(rows))
+                    else:
+                        rows_str = ",".join(row_ranges(rows))
+                    err_list.append(err_log[err]["msg"] + ", rows: " + rows_str)
+                    if err not in info_only:
+                        err_return = True
+
+            err_message = "\n".join(e for e in err_list)
+            if err_list:
+                logging.info(err_message)
+            if err_return:
+                logging.info(f"Errors found, {output_db} not written")
+            else:
+                logging.info("No errors found")
+                os.replace(tmp_db, output_db)
+                logging.info(f"{len(recnames)} records written")
+                logging.info(f"{len(err_log['ignored']['rows'])} records ignored")
+        finally:
+            if os.path.exists(tmp_db):
+                os.unlink(tmp_db)
 
-    except Exception as e:
-        print(f"Error processing the file: {e}")
+    return err_return
 
 
 def main():
@@ -228,6 +285,13 @@ def main():
         help="Run in verbose mode"
     )
 
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        required=False,
+        help="Stop checking the input at the first row with an error"
+    )
+
     args = parser.parse_args()
 
     if args.verbose:
@@ -241,8 +305,8 @@ def main():
     logging.info(f"Arguments: {args.__dict__}")
 
     # Process the input CSV and generate the EPICS database
-    if not input_error(args.input_path):
-        process_csv(args.input_path, args.output_db)
+    # Exit non-zero when errors prevented the database from being written
+    sys.exit(1 if process(args.input_path, args.output_db, args.fail_fast) else 0)
 
 
 if __name__ == "__main__":